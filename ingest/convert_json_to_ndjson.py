@@ -1,50 +1,61 @@
 import argparse
-import json
 import os
-import io
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+import orjson
 from minio import Minio
 from minio.error import S3Error
 
 
-def to_bulk_actions(book_json: Dict, index_books: str, index_content: str) -> List[str]:
-    actions: List[str] = []
+def to_bulk_actions(book_json: Dict, index_books: str, index_content: str) -> Tuple[List[bytes], List[Optional[bytes]]]:
+    books_part: List[bytes] = []
+    bid = book_json.get("book_id")
+    title = book_json.get("title")
+    author = book_json.get("author", "")
     book_doc = {
-        "book_id": book_json.get("book_id"),
+        "book_id": bid,
         "source_uid": book_json.get("source_uid", ""),
-        "title": book_json.get("title"),
-        "author": book_json.get("author", ""),
+        "title": title,
+        "author": author,
         "publisher": book_json.get("publisher", ""),
         "description": book_json.get("description", ""),
         "genres": book_json.get("genres", ""),
         "linkToBook": book_json.get("linkToBook", ""),
         "language": book_json.get("language"),
         "suggest": {
-            "input": ([book_json.get("title")] if book_json.get("title") else [])
-                      + ([book_json.get("author")] if book_json.get("author") else [])
+            "input": ([title] if title else []) + ([author] if author else [])
         }
     }
-    actions.append(json.dumps({"index": {"_index": index_books, "_id": book_doc["book_id"]}}))
-    actions.append(json.dumps(book_doc, ensure_ascii=False))
-
+    books_part.append(orjson.dumps({"index": {"_index": index_books, "_id": bid}}, option=orjson.OPT_APPEND_NEWLINE))
+    books_part.append(orjson.dumps(book_doc, option=orjson.OPT_APPEND_NEWLINE))
+
+    # identical for every paragraph, so serialize it once
+    content_meta = orjson.dumps({"index": {"_index": index_content}}, option=orjson.OPT_APPEND_NEWLINE)
+    chunk_prefix = f"{bid}-"
+    chapters = book_json.get("chapters", [])
+    # meta + source per paragraph; size the list up front and fill by index
+    content_part: List[Optional[bytes]] = [None] * (2 * sum(len(ch.get("paragraphs", [])) for ch in chapters))
     seq = 0
-    for chapter_index, ch in enumerate(book_json.get("chapters", [])):
+    for chapter_index, ch in enumerate(chapters):
         chapter = ch.get("chapter")
         for paragraph_index, para in enumerate(ch.get("paragraphs", [])):
             doc = {
-                "book_id": book_json.get("book_id"),
-                "chunk_id": f"{book_json.get('book_id')}-{seq:06d}",
+                "book_id": bid,
+                "chunk_id": chunk_prefix + "%06d" % seq,
                 "chapter": chapter,
                 "chapter_index": chapter_index,
                 "paragraph_index": paragraph_index,
                 "text": para,
             }
-            actions.append(json.dumps({"index": {"_index": index_content}}))
-            actions.append(json.dumps(doc, ensure_ascii=False))
+            content_part[2 * seq] = content_meta
+            content_part[2 * seq + 1] = orjson.dumps(doc, option=orjson.OPT_APPEND_NEWLINE)
             seq += 1
 
-    return actions
+    return books_part, content_part
 
 
 def main():
@@ -59,26 +70,20 @@ def main():
     args = p.parse_args()
 
     def process_json_objects(json_iter):
-        books_lines: List[str] = []
-        content_lines: List[str] = []
+        # yields newline-terminated (books_lines, content_lines) one book at a time so nothing is buffered past a single book
         for name, data in json_iter:
             try:
-                actions = to_bulk_actions(data, args.index_books, args.index_content)
-                for i in range(0, len(actions), 2):
-                    meta = json.loads(actions[i])
-                    src = actions[i+1]
-                    idx = meta["index"]["_index"]
-                    if idx == args.index_books:
-                        books_lines.append(actions[i])
-                        books_lines.append(src)
-                    else:
-                        meta_no_id = {"index": {"_index": args.index_content}}
-                        content_lines.append(json.dumps(meta_no_id))
-                        content_lines.append(src)
-                print(f"OK {name}")
+                books_part, content_part = to_bulk_actions(data, args.index_books, args.index_content)
             except Exception as e:
                 print(f"ERROR {name}: {e}")
-        return books_lines, content_lines
+                continue
+            yield books_part, content_part
+            print(f"OK {name}")
+
+    def write_ndjson(json_iter, out_books, out_content):
+        for books_part, content_part in process_json_objects(json_iter):
+            out_books.writelines(books_part)
+            out_content.writelines(content_part)
 
     if args.s3:
         endpoint = os.getenv("MINIO_ENDPOINT", "localhost:9000")
@@ -88,30 +93,64 @@ def main():
         parsed_bucket = os.getenv("PARSED_BUCKET", "parsed")
         index_bucket = os.getenv("INDEX_BUCKET", "index")
 
+        concurrency = max(1, int(os.getenv("INGEST_CONCURRENCY", "32")))
+
         client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure)
+        local = threading.local()
+
+        def thread_client() -> Minio:
+            # one client (and connection pool) per worker thread
+            if not hasattr(local, "client"):
+                local.client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure)
+            return local.client
+
+        def fetch_json(obj):
+            resp = thread_client().get_object(parsed_bucket, obj.object_name)
+            try:
+                buf = resp.read()
+            finally:
+                resp.close(); resp.release_conn()
+            try:
+                return obj.object_name, orjson.loads(buf)
+            except Exception as e:
+                print(f"ERROR decode {obj.object_name}: {e}")
+                return obj.object_name, None
 
         def iter_json_from_s3():
-            for obj in client.list_objects(parsed_bucket, prefix=args.prefix, recursive=True):
-                if not obj.object_name.lower().endswith(".json"):
-                    continue
-                resp = client.get_object(parsed_bucket, obj.object_name)
-                try:
-                    buf = resp.read()
-                finally:
-                    resp.close(); resp.release_conn()
-                try:
-                    data = json.loads(buf.decode("utf-8"))
-                except Exception as e:
-                    print(f"ERROR decode {obj.object_name}: {e}")
-                    continue
-                yield obj.object_name, data
-
-        books_lines, content_lines = process_json_objects(iter_json_from_s3())
-
-        books_bytes = ("\n".join(books_lines) + "\n").encode("utf-8")
-        content_bytes = ("\n".join(content_lines) + "\n").encode("utf-8")
-        client.put_object(index_bucket, "books.ndjson", data=io.BytesIO(books_bytes), length=len(books_bytes))
-        client.put_object(index_bucket, "book_content.ndjson", data=io.BytesIO(content_bytes), length=len(content_bytes))
+            objects = [
+                obj for obj in client.list_objects(parsed_bucket, prefix=args.prefix, recursive=True)
+                if obj.object_name.lower().endswith(".json")
+            ]
+            # overlap GETs but keep at most `concurrency` parsed books waiting on the writer;
+            # results come back in listing order so output stays deterministic
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                in_flight = deque()
+                for obj in objects:
+                    if len(in_flight) >= concurrency:
+                        name, data = in_flight.popleft().result()
+                        if data is not None:
+                            yield name, data
+                    in_flight.append(executor.submit(fetch_json, obj))
+                while in_flight:
+                    name, data = in_flight.popleft().result()
+                    if data is not None:
+                        yield name, data
+
+        def upload(key, f):
+            f.seek(0)
+            thread_client().put_object(index_bucket, key, data=f, length=-1, part_size=16 << 20)
+
+        # spool to disk past 64 MB, then multipart-upload both files side by side in 16 MB parts
+        with tempfile.SpooledTemporaryFile(max_size=64 << 20) as books_f, \
+                tempfile.SpooledTemporaryFile(max_size=64 << 20) as content_f:
+            write_ndjson(iter_json_from_s3(), books_f, content_f)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    executor.submit(upload, "books.ndjson", books_f),
+                    executor.submit(upload, "book_content.ndjson", content_f),
+                ]
+                for fut in futures:
+                    fut.result()
         print(f"S3 write: s3://{index_bucket}/books.ndjson and book_content.ndjson")
         return
 
@@ -120,15 +159,14 @@ def main():
 
     def iter_json_local():
         for f in sorted(args.input_dir.glob("*.json")):
-            data = json.loads(f.read_text(encoding="utf-8"))
+            data = orjson.loads(f.read_bytes())
             yield f.name, data
 
-    books_lines, content_lines = process_json_objects(iter_json_local())
-
     args.out_books.parent.mkdir(parents=True, exist_ok=True)
-    args.out_books.write_text("\n".join(books_lines) + "\n", encoding="utf-8")
     args.out_content.parent.mkdir(parents=True, exist_ok=True)
-    args.out_content.write_text("\n".join(content_lines) + "\n", encoding="utf-8")
+    with open(args.out_books, "wb", buffering=1 << 20) as books_f, \
+            open(args.out_content, "wb", buffering=1 << 20) as content_f:
+        write_ndjson(iter_json_local(), books_f, content_f)
 
 
 if __name__ == "__main__":
@@ -1,34 +1,84 @@
 import argparse
-import json
+import codecs
 import os
 import re
 import hashlib
 import tempfile
 import io
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from ebooklib import epub, ITEM_DOCUMENT
-from bs4 import BeautifulSoup
+from lxml import etree
+import orjson
 from minio import Minio
 from minio.error import S3Error
 
 
+_ISBN_RE = re.compile(r"\d{10}|\d{13}")
+_AUTHOR_RE = re.compile(r"\b[Bb]y\s+([^\n,]+)")
+_PUBLISHER_RE = re.compile(r"[Pp]ublisher:?\s*([^\n]+)")
+# XML declaration or <meta charset>/http-equiv near the top of the document
+_DECLARED_ENCODING_RE = re.compile(rb"""(?:encoding|charset)\s*=\s*["']?([\w.:-]+)""", re.I)
+# lxml parsers must not be shared between threads (S3 mode parses in a thread pool)
+_HTML_PARSERS = threading.local()
+
+
+def _html_parser(content: bytes) -> etree.HTMLParser:
+    # libxml2's HTML parser ignores XML declarations and guesses Latin-1 when nothing is
+    # declared, so pass the encoding explicitly; XHTML without a declaration is UTF-8
+    # a BOM (or UTF-16's interleaved NULs, XML 1.0 appendix F) wins over any declaration,
+    # which the ASCII regex below can't see in UTF-16 anyway
+    if content.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8"
+    elif content.startswith(codecs.BOM_UTF16_LE) or content.startswith(b"<\x00"):
+        encoding = "utf-16le"
+    elif content.startswith(codecs.BOM_UTF16_BE) or content.startswith(b"\x00<"):
+        encoding = "utf-16be"
+    else:
+        m = _DECLARED_ENCODING_RE.search(content[:1024])
+        encoding = m.group(1).decode("ascii").lower() if m else "utf-8"
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = "utf-8"
+    parsers = getattr(_HTML_PARSERS, "by_encoding", None)
+    if parsers is None:
+        parsers = _HTML_PARSERS.by_encoding = {}
+    if encoding not in parsers:
+        parsers[encoding] = etree.HTMLParser(encoding=encoding)
+    return parsers[encoding]
+
+
+def _itertext(el, sep: str) -> str:
+    # BeautifulSoup's get_text(sep, strip=True), given script/style were stripped from the tree
+    return sep.join(t.strip() for t in el.itertext() if t.strip())
+
+
 def extract_texts_from_item(item) -> Tuple[str, List[str]]:
-    soup = BeautifulSoup(item.get_content(), "lxml")
+    content = item.get_content()
+    tree = etree.HTML(content, _html_parser(content))
+    if tree is None:
+        return item.get_name(), []
+    # bs4's get_text never returned script/style contents; keep their tails (real text)
+    etree.strip_elements(tree, "script", "style", with_tail=False)
     chapter = None
-    h = soup.find(["h1", "h2", "h3", "title"]) or {}
+    h = tree.xpath("(//h1|//h2|//h3|//title)[1]")
     if h:
-        chapter = h.get_text(" ", strip=True)
+        chapter = _itertext(h[0], " ")
 
     texts: List[str] = []
-    for tag in soup.find_all(["p", "li", "pre"]):
-        txt = tag.get_text("\n", strip=True)
+    for tag in tree.xpath("//p|//li|//pre"):
+        txt = _itertext(tag, "\n")
         if txt:
             texts.append(txt)
 
     if not texts:
-        body = soup.body.get_text("\n", strip=True) if soup.body else soup.get_text("\n", strip=True)
+        body = tree.find("body")
+        body = _itertext(body if body is not None else tree, "\n")
         chunks = [b.strip() for b in body.split("\n\n") if b.strip()]
         texts.extend(chunks)
 
@@ -48,7 +98,7 @@ essential_meta = [
 def _pick_isbn(values: List[str]) -> str:
     for v in values:
         cleaned = v.replace(" ", "").replace("-", "")
-        if re.fullmatch(r"\d{10}|\d{13}", cleaned):
+        if _ISBN_RE.fullmatch(cleaned):
             return cleaned
 
 
@@ -84,15 +134,15 @@ def _pick_stable_id(book, epub_path: Path) -> str:
                 return val
     if first_val:
         return first_val
-    import hashlib
-    h = hashlib.sha1()
+    # content hash fallback; prefixed so it can't collide with the older sha1 ids
     with open(epub_path, "rb") as rf:
-        while True:
-            chunk = rf.read(1024 * 1024)
-            if not chunk:
-                break
-            h.update(chunk)
-    return h.hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            h = hashlib.file_digest(rf, lambda: hashlib.blake2b(digest_size=8))
+        else:
+            h = hashlib.blake2b(digest_size=8)
+            for chunk in iter(lambda: rf.read(1024 * 1024), b""):
+                h.update(chunk)
+    return f"blake2b:{h.hexdigest()}"
 
 
 def read_epub(epub_path: Path) -> Dict:
@@ -156,16 +206,18 @@ def read_epub(epub_path: Path) -> Dict:
         if joined:
             data["description"] = joined[:2000]
 
-    if not data.get("author") and data.get("chapters"):
-        head = "\n".join(data["chapters"][0].get("paragraphs", [])[:10])
-        m = re.search(r"\b[Bb]y\s+([^\n,]+)", head)
-        if m:
-            data["author"] = m.group(1).strip()
-    if not data.get("publisher") and data.get("chapters"):
-        head = "\n".join(data["chapters"][0].get("paragraphs", [])[:20])
-        m = re.search(r"[Pp]ublisher:?\s*([^\n]+)", head)
-        if m:
-            data["publisher"] = m.group(1).strip()
+    if data.get("chapters") and not (data.get("author") and data.get("publisher")):
+        # author looks at the first 10 paragraphs, publisher at the first 20; join the shared part once
+        paras = data["chapters"][0].get("paragraphs", [])
+        head = "\n".join(paras[:10])
+        if not data.get("author"):
+            m = _AUTHOR_RE.search(head)
+            if m:
+                data["author"] = m.group(1).strip()
+        if not data.get("publisher"):
+            m = _PUBLISHER_RE.search("\n".join([head] + paras[10:20]))
+            if m:
+                data["publisher"] = m.group(1).strip()
 
     stem = epub_path.stem
     if not data.get("author"):
@@ -173,15 +225,22 @@ def read_epub(epub_path: Path) -> Dict:
         if author_slug and len(author_slug.split()) <= 4:
             data["author"] = author_slug.title()
     if not data.get("publisher") and data.get("chapters"):
-        all_text = "\n".join(
-            [p for ch in data.get("chapters", [])[:5] for p in ch.get("paragraphs", [])[:50]]
-        )
-        if "Standard Ebooks" in all_text:
+        # stops at the first hit instead of joining the first 5 chapters
+        if any("Standard Ebooks" in p for ch in data["chapters"][:5] for p in ch.get("paragraphs", [])[:50]):
             data["publisher"] = "Standard Ebooks"
 
     return data
 
 
+def _read_epub_worker(epub_path: Path) -> Tuple[Path, Optional[Dict], Optional[str]]:
+    # module level so multiprocessing can pickle it; errors go back as text since
+    # not every exception survives pickling
+    try:
+        return epub_path, read_epub(epub_path), None
+    except Exception as e:
+        return epub_path, None, str(e)
+
+
 def main():
     p = argparse.ArgumentParser(description="Extract EPUB into structured JSON per book")
     p.add_argument("input", nargs="?", type=Path, help="EPUB file or folder with EPUBs (local mode)")
@@ -197,17 +256,25 @@ def main():
         secure = os.getenv("MINIO_SECURE", "false").lower() == "true"
         raw_bucket = os.getenv("RAW_BUCKET", "raw")
         parsed_bucket = os.getenv("PARSED_BUCKET", "parsed")
+        concurrency = max(1, int(os.getenv("INGEST_CONCURRENCY", "32")))
 
         client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure)
+        local = threading.local()
+
+        def thread_client() -> Minio:
+            # one client (and connection pool) per worker thread
+            if not hasattr(local, "client"):
+                local.client = Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure)
+            return local.client
+
         try:
             if not client.bucket_exists(parsed_bucket):
                 client.make_bucket(parsed_bucket)
         except S3Error:
             pass
 
-        for obj in client.list_objects(raw_bucket, prefix=args.prefix, recursive=True):
-            if not obj.object_name.lower().endswith(".epub"):
-                continue
+        def process_one(obj):
+            client = thread_client()
             try:
                 with tempfile.TemporaryDirectory() as td:
                     tmp_path = Path(td) / Path(obj.object_name).name
@@ -222,7 +289,7 @@ def main():
 
                     data = read_epub(tmp_path)
                     data["linkToBook"] = f"s3://{raw_bucket}/{obj.object_name}"
-                    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+                    json_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
                     out_key = f"{Path(obj.object_name).with_suffix('.json').name}"
                     client.put_object(
                         parsed_bucket,
@@ -234,6 +301,14 @@ def main():
                     print(f"OK s3://{raw_bucket}/{obj.object_name} -> s3://{parsed_bucket}/{out_key}")
             except Exception as e:
                 print(f"ERROR s3://{raw_bucket}/{obj.object_name}: {e}")
+
+        objects = [
+            obj for obj in client.list_objects(raw_bucket, prefix=args.prefix, recursive=True)
+            if obj.object_name.lower().endswith(".epub")
+        ]
+        # GET/PUT latency dominates here, so threads are enough to overlap books
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(process_one, objects))
         return
 
     if not args.input or not args.output_dir:
@@ -247,19 +322,24 @@ def main():
     else:
         inputs = [args.input]
 
-    for ep in inputs:
-        try:
-            data = read_epub(ep)
+    workers = max(1, int(os.environ.get("EPUB_WORKERS", (os.cpu_count() or 2) - 1)))
+    # about four tasks per worker: big enough to amortize IPC, small enough to spread a short list
+    chunksize = max(1, len(inputs) // (workers * 4))
+    with multiprocessing.Pool(workers) as pool:
+        for ep, data, err in pool.imap_unordered(_read_epub_worker, inputs, chunksize=chunksize):
+            if err is not None:
+                print(f"ERROR {ep}: {err}")
+                continue
             try:
-                data["linkToBook"] = f"file://{ep.resolve()}"
-            except Exception:
-                data["linkToBook"] = str(ep)
-            out_path = args.output_dir / f"{ep.stem}.json"
-            with out_path.open("w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"OK {ep.name} -> {out_path}")
-        except Exception as e:
-            print(f"ERROR {ep}: {e}")
+                try:
+                    data["linkToBook"] = f"file://{ep.resolve()}"
+                except Exception:
+                    data["linkToBook"] = str(ep)
+                out_path = args.output_dir / f"{ep.stem}.json"
+                out_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+                print(f"OK {ep.name} -> {out_path}")
+            except Exception as e:
+                print(f"ERROR {ep}: {e}")
 
 
 if __name__ == "__main__":
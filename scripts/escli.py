@@ -3,30 +3,50 @@ import json
 import os
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Iterable, List, Tuple
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
 try:
     from sentence_transformers import SentenceTransformer
     import numpy as np
+    import torch
 except Exception:
     SentenceTransformer = None
     np = None
+    torch = None
+
+try:
+    from fastembed import TextEmbedding
+    import numpy as np
+except Exception:
+    TextEmbedding = None
 
 ROOT = Path(__file__).resolve().parents[1]
 MAP_DIR = ROOT / "mappings"
 DEFAULT_ES = os.getenv("ES_URL", "http://localhost:9200")
 
 
+_SESSION = None
+
+
 def _session() -> requests.Session:
-    s = requests.Session()
-    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
-    s.mount("http://", HTTPAdapter(max_retries=retries))
-    s.mount("https://", HTTPAdapter(max_retries=retries))
-    return s
+    # one keep-alive session for the whole process so bulk posts reuse connections
+    global _SESSION
+    if _SESSION is None:
+        s = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=16, pool_maxsize=32)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        s.headers["Connection"] = "keep-alive"
+        _SESSION = s
+    return _SESSION
 
 
 def es_request(method: str, url: str, **kw):
@@ -53,33 +73,41 @@ def init_indices(es: str):
 
 
 def index_exists(es: str, name: str) -> bool:
-    r = requests.get(f"{es}/{name}")
+    r = _session().get(f"{es}/{name}", timeout=60)
     return r.status_code == 200
 
 
-def bulk_file(es: str, ndjson_path: Path, chunk_bytes: int = 5 * 1024 * 1024):
+def bulk_file(es: str, ndjson_path: Path, chunk_bytes: int = 5 * 1024 * 1024, max_in_flight: int = 4):
     ndjson_path = Path(ndjson_path)
-    buf: List[str] = []
+    buf: List[bytes] = []
     size = 0
     sent = 0
-    with ndjson_path.open("r", encoding="utf-8") as f:
+    in_flight = deque()
+    # keep reading the next chunk while up to max_in_flight bulk requests are running
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor, open(ndjson_path, "rb") as f:
         for line in f:
             if not line.strip():
                 continue
+            if not line.endswith(b"\n"):
+                line += b"\n"
             buf.append(line)
-            size += len(line.encode("utf-8"))
+            size += len(line)
             if size >= chunk_bytes:
-                _bulk_post(es, "".join(buf))
+                if len(in_flight) >= max_in_flight:
+                    in_flight.popleft().result()
+                in_flight.append(executor.submit(_bulk_post, es, b"".join(buf)))
                 sent += len(buf) // 2
                 buf, size = [], 0
         if buf:
-            _bulk_post(es, "".join(buf))
+            in_flight.append(executor.submit(_bulk_post, es, b"".join(buf)))
             sent += len(buf) // 2
+        while in_flight:
+            in_flight.popleft().result()
     print(f"OK bulk indexed ~{sent} docs from {ndjson_path.name}")
 
 
-def _bulk_post(es: str, data: str):
-    r = es_request("POST", f"{es}/_bulk", data=data.encode("utf-8"), headers={"Content-Type": "application/x-ndjson"})
+def _bulk_post(es: str, data: bytes):
+    r = es_request("POST", f"{es}/_bulk", data=data, headers={"Content-Type": "application/x-ndjson"})
     resp = r.json()
     if resp.get("errors"):
         # show first error
@@ -88,21 +116,53 @@ def _bulk_post(es: str, data: str):
                 raise RuntimeError(f"Bulk error: {json.dumps(item, ensure_ascii=False)}")
 
 
-def _load_model(model_name: str) -> SentenceTransformer:
+class _FastEmbedModel:
+    """ONNX Runtime backend exposing the subset of SentenceTransformer.encode used here."""
+
+    def __init__(self, model_name: str):
+        self.model = TextEmbedding(model_name=model_name, threads=os.cpu_count())
+
+    def encode(self, texts: List[str], batch_size: int = 64, normalize_embeddings: bool = False, **kw):
+        vecs = np.stack(list(self.model.embed(texts, batch_size=batch_size))).astype(np.float32)
+        if normalize_embeddings:
+            vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        return vecs
+
+
+def _load_model(model_name: str, backend: str = "auto"):
+    # fastembed loads in about a second and is faster on CPU; torch stays the fallback
+    if backend == "fastembed":
+        if TextEmbedding is None:
+            raise RuntimeError("fastembed not installed. pip install fastembed")
+        return _FastEmbedModel(model_name)
+    if backend == "auto" and TextEmbedding is not None:
+        try:
+            return _FastEmbedModel(model_name)
+        except Exception as e:
+            # e.g. a model fastembed doesn't support; fall through to sentence-transformers
+            print(f"fastembed unavailable for {model_name} ({e}), falling back to sentence-transformers")
     if SentenceTransformer is None:
         raise RuntimeError("sentence-transformers not installed. pip install -r scripts/requirements.txt")
+    if torch.cuda.is_available():
+        # fp16 on GPU halves activation memory and runs on tensor cores
+        return SentenceTransformer(model_name, device="cuda").half()
     return SentenceTransformer(model_name)
 
 
+def _quantize(vecs):
+    # normalized float32 -> int8 for dense_vector element_type "byte"
+    return np.clip(np.round(vecs * 127), -128, 127).astype(np.int8)
+
+
 def _iter_ndjson_docs(path: Path) -> Iterable[dict]:
-    with Path(path).open("r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         expect_src = False
         meta = None
         for line in f:
             line = line.strip()
             if not line:
                 continue
-            obj = json.loads(line)
+            obj = orjson.loads(line)
             if "index" in obj:
                 meta = obj
                 expect_src = True
@@ -113,41 +173,51 @@ def _iter_ndjson_docs(path: Path) -> Iterable[dict]:
                 expect_src = False
 
 
-def embed_from_ndjson(es: str, ndjson_path: Path, source_field: str, target_field: str, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", index_override: str = None):
-    model = _load_model(model_name)
-    to_update: List[str] = []
+def embed_from_ndjson(es: str, ndjson_path: Path, source_field: str, target_field: str, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", index_override: str = None, batch_size: int = 64, backend: str = "auto"):
+    model = _load_model(model_name, backend)
+    to_update: List[bytes] = []
+    batch: List[Tuple[str, dict, dict, str]] = []
     total = 0
+
+    def flush_batch():
+        texts = [text for _, _, _, text in batch]
+        vecs = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+        vecs = _quantize(vecs)
+        # orjson writes the ndarray rows directly, no per-element Python objects
+        for (idx, meta, src, _), vec in zip(batch, vecs):
+            if "_id" not in meta["index"]:
+                src[target_field] = vec
+                to_update.append(orjson.dumps({"index": {"_index": idx}}, option=orjson.OPT_APPEND_NEWLINE))
+                to_update.append(orjson.dumps(src, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE))
+            else:
+                _id = meta["index"]["_id"]
+                to_update.append(orjson.dumps({"update": {"_index": idx, "_id": _id}}, option=orjson.OPT_APPEND_NEWLINE))
+                to_update.append(orjson.dumps({"doc": {target_field: vec}}, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE))
+        batch.clear()
+
     for meta, src in _iter_ndjson_docs(ndjson_path):
         idx = index_override or meta["index"]["_index"]
-        if "_id" not in meta["index"]:
-            text = src.get(source_field, "")
-            if not text:
-                continue
-            vec = model.encode([text])[0].tolist()
-            src[target_field] = vec
-            to_update.append(json.dumps({"index": {"_index": idx}}))
-            to_update.append(json.dumps(src, ensure_ascii=False))
-        else:
-            _id = meta["index"]["_id"]
-            text = src.get(source_field, "")
-            if not text:
-                continue
-            vec = model.encode([text])[0].tolist()
-            to_update.append(json.dumps({"update": {"_index": idx, "_id": _id}}))
-            to_update.append(json.dumps({"doc": {target_field: vec}}))
+        text = src.get(source_field, "")
+        if not text:
+            continue
+        batch.append((idx, meta, src, text))
+        if len(batch) >= batch_size:
+            flush_batch()
         if len(to_update) >= 1000:
-            _bulk_post(es, "\n".join(to_update) + "\n")
+            _bulk_post(es, b"".join(to_update))
             total += len(to_update) // 2
             to_update = []
+    if batch:
+        flush_batch()
     if to_update:
-        _bulk_post(es, "\n".join(to_update) + "\n")
+        _bulk_post(es, b"".join(to_update))
         total += len(to_update) // 2
     print(f"OK embedded+indexed ~{total} items from {Path(ndjson_path).name} -> field {target_field}")
 
 
-def knn_test(es: str, index: str, field: str, query: str, k: int = 5, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-    model = _load_model(model_name)
-    vec = model.encode([query])[0].tolist()
+def knn_test(es: str, index: str, field: str, query: str, k: int = 5, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", backend: str = "auto"):
+    model = _load_model(model_name, backend)
+    vec = _quantize(model.encode([query], convert_to_numpy=True, normalize_embeddings=True))[0].tolist()
     body = {
         "knn": {
             "field": field,
@@ -186,6 +256,7 @@ def main():
     p_embed.add_argument("--index-override", default=None, help="force index name when NDJSON has no _id/meta")
     p_embed.add_argument("--es", default=DEFAULT_ES)
     p_embed.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    p_embed.add_argument("--backend", choices=["auto", "fastembed", "torch"], default="auto", help="auto: fastembed if installed, else torch")
 
     p_knn = sub.add_parser("knn-test")
     p_knn.add_argument("--index", required=True)
@@ -194,6 +265,7 @@ def main():
     p_knn.add_argument("--k", type=int, default=5)
     p_knn.add_argument("--es", default=DEFAULT_ES)
     p_knn.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    p_knn.add_argument("--backend", choices=["auto", "fastembed", "torch"], default="auto", help="auto: fastembed if installed, else torch")
 
     args = ap.parse_args()
 
@@ -202,9 +274,9 @@ def main():
     elif args.cmd == "bulk":
         bulk_file(args.es, args.file)
     elif args.cmd == "embed-from-ndjson":
-        embed_from_ndjson(args.es, args.file, args.source_field, args.target_field, args.model, args.index_override)
+        embed_from_ndjson(args.es, args.file, args.source_field, args.target_field, args.model, args.index_override, backend=args.backend)
     elif args.cmd == "knn-test":
-        knn_test(args.es, args.index, args.field, args.query, args.k, args.model)
+        knn_test(args.es, args.index, args.field, args.query, args.k, args.model, args.backend)
     else:
         raise SystemExit(1)
 